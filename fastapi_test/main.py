@@ -1,25 +1,76 @@
-import json
+import asyncio
+import logging
+import multiprocessing
 import os
 import re
 import time
-from collections import defaultdict, deque
+import uuid
+from array import array
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from threading import Lock
 from io import BytesIO
-from typing import Deque, Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+import orjson
 from pydantic import BaseModel, Field
 from pypdf import PdfReader, PdfWriter
 from pypdf.generic import BooleanObject, NameObject
 from reportlab.pdfgen import canvas
 
-app = FastAPI()
+try:
+    import redis.asyncio as redis_asyncio
+    from redis.exceptions import RedisError
+except ImportError:
+    redis_asyncio = None
+
+# With several uvicorn workers, each one gets its own pool; lower this to avoid oversubscribing CPUs.
+PDF_POOL_WORKERS = int(os.environ.get("PDF_POOL_WORKERS", os.cpu_count() or 1))
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    if _pdf_pool is None:
+        # Spawn rather than fork: a forked child could inherit _pdf_lock while a threadpool
+        # request holds it and then deadlock in _load_pdf_bytes.
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=PDF_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pdf_pool
+
+
+def _discard_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    global _pdf_pool
+    if _pdf_pool is pool:
+        _pdf_pool = None
+    pool.shutdown(wait=False)
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    yield
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown()
+    if _redis is not None:
+        await _redis.aclose()
+
+
+logger = logging.getLogger(__name__)
+app = FastAPI(lifespan=_lifespan, default_response_class=ORJSONResponse)
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 OFFICIAL_PDF_PATH = os.path.join("static", "Application-for-a-Permanent-Resident-Card.pdf")
+_pdf_lock = Lock()
+_pdf_cache: Dict[str, Tuple[float, bytes]] = {}
+_pdf_fields_cache: Dict[str, Tuple[bytes, bytes]] = {}
 
 languages = [
     {"code": "en", "label": "English", "flag": "🇬🇧", "text": "Hello! This is a simple multilingual page."},
@@ -30,8 +81,87 @@ languages = [
 ]
 
 RATE_LIMIT_PER_MIN = 10
-_rate_lock = Lock()
-_rate_bucket: Dict[str, Deque[float]] = defaultdict(deque)
+
+
+class _RateWindow:
+    """Ring buffer of the last RATE_LIMIT_PER_MIN request times for one IP."""
+
+    __slots__ = ("times", "head", "count")
+
+    def __init__(self) -> None:
+        self.times = array("d", [0.0]) * RATE_LIMIT_PER_MIN
+        self.head = 0
+        self.count = 0
+
+
+class _RateBuckets(OrderedDict):
+    """LRU map of IP to _RateWindow, capped so spoofed IPs cannot grow it forever."""
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__()
+        self.capacity = capacity
+
+    def get_or_create(self, ip: str) -> _RateWindow:
+        window = self.get(ip)
+        if window is not None:
+            self.move_to_end(ip)
+            return window
+        if len(self) >= self.capacity:
+            self.popitem(last=False)
+        window = self[ip] = _RateWindow()
+        return window
+
+
+# Buckets are split across stripes so requests from different IPs rarely share a lock.
+RATE_LOCK_STRIPES = 64
+RATE_MAX_TRACKED_IPS = 100_000
+_rate_stripes: List[Tuple[_RateBuckets, asyncio.Lock]] = [
+    (_RateBuckets(RATE_MAX_TRACKED_IPS // RATE_LOCK_STRIPES), asyncio.Lock())
+    for _ in range(RATE_LOCK_STRIPES)
+]
+
+# Shared sliding-window log so the limit holds across uvicorn workers and hosts.
+REDIS_URL = os.environ.get("REDIS_URL")
+_RATE_LIMIT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. (tonumber(ARGV[1]) - tonumber(ARGV[2])))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 1
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 0
+"""
+REDIS_RETRY_COOLDOWN_SEC = 30
+_redis = None
+_rate_limit_script = None
+_redis_retry_at = 0.0
+if REDIS_URL and redis_asyncio is None:
+    logger.warning("REDIS_URL is set but the redis package is not installed; using per-worker limits.")
+elif REDIS_URL:
+    _redis = redis_asyncio.from_url(REDIS_URL, socket_connect_timeout=0.5, socket_timeout=0.5)
+    _rate_limit_script = _redis.register_script(_RATE_LIMIT_LUA)
+
+_SCRIPT_RE = re.compile(r"<script\b[^>]*>.*?</script>", re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r"<[^>]+>")
+# Every sensitive pattern needs at least one digit or capital letter to match.
+_SENSITIVE_HINT_RE = re.compile(r"[\dA-Z]")
+_SENSITIVE_PATTERNS = [
+    (re.compile(pattern), label)
+    for pattern, label in [
+        (r"\b\d{3}-\d{2}-\d{4}\b", "SSN/SIN"),
+        (r"\b\d{9}\b", "SIN"),
+        (r"\b(?:\d[ -]*?){13,19}\b", "credit card"),
+        (r"\b[A-Z]{1,2}\d{6,8}\b", "passport"),
+        (r"\b[A-Z0-9]{8,9}\b", "passport"),
+    ]
+]
+
+_DEVELOPER_PROMPT = (
+    "You are an assistant that helps users fill Canadian PR forms. "
+    "Focus ONLY on the selected field. Do NOT provide legal advice. "
+    "Warn if sensitive data is present. Respond in the user's language. "
+    "Return a JSON object with keys: assistant_answer, suggested_fill_en, warnings."
+)
 
 
 class ChatRequest(BaseModel):
@@ -74,51 +204,71 @@ def _get_client_ip(request: Request) -> str:
     return request.client.host if request.client else "unknown"
 
 
-def _rate_limited(ip: str) -> bool:
+async def _rate_limited(ip: str) -> bool:
+    global _redis_retry_at
+    if _rate_limit_script is not None and time.monotonic() >= _redis_retry_at:
+        try:
+            limited = await _rate_limit_script(
+                keys=[f"ratelimit:{ip}"],
+                args=[time.time(), 60, RATE_LIMIT_PER_MIN, uuid.uuid4().hex],
+            )
+            return bool(limited)
+        except (RedisError, OSError) as exc:
+            # Back off so requests do not each wait on the socket timeout, and log once per
+            # cooldown: until Redis is back, every worker enforces the limit on its own.
+            now = time.monotonic()
+            if now >= _redis_retry_at:
+                _redis_retry_at = now + REDIS_RETRY_COOLDOWN_SEC
+                logger.warning(
+                    "Redis rate limiting failed (%s); using per-worker limits for %ss.",
+                    exc,
+                    REDIS_RETRY_COOLDOWN_SEC,
+                )
+    # Redis is not configured or unreachable: fall back to this worker's own buckets.
+    return await _rate_limited_local(ip)
+
+
+async def _rate_limited_local(ip: str) -> bool:
     now = time.monotonic()
-    with _rate_lock:
-        q = _rate_bucket[ip]
-        while q and now - q[0] > 60:
-            q.popleft()
-        if len(q) >= RATE_LIMIT_PER_MIN:
+    bucket, lock = _rate_stripes[hash(ip) & (RATE_LOCK_STRIPES - 1)]
+    # There is no await in this block, so the event loop already runs it atomically; the
+    # lock only keeps it correct if an await is ever added here.
+    async with lock:
+        window = bucket.get_or_create(ip)
+        head = window.head
+        # Once full, the head slot holds the oldest of the last N requests.
+        if window.count == RATE_LIMIT_PER_MIN and now - window.times[head] <= 60:
             return True
-        q.append(now)
+        window.times[head] = now
+        window.head = (head + 1) % RATE_LIMIT_PER_MIN
+        if window.count < RATE_LIMIT_PER_MIN:
+            window.count += 1
     return False
 
 
 def _strip_html(text: str) -> str:
-    text = re.sub(r"<script\b[^>]*>.*?</script>", "", text, flags=re.IGNORECASE | re.DOTALL)
-    text = re.sub(r"<[^>]+>", "", text)
+    if "<" not in text:
+        return text
+    text = _SCRIPT_RE.sub("", text)
+    text = _TAG_RE.sub("", text)
     return text
 
 
 def _mask_sensitive(text: str) -> (str, List[str]):
     warnings = []
+    if _SENSITIVE_HINT_RE.search(text) is None:
+        return text, warnings
     masked = text
 
-    patterns = [
-        (r"\b\d{3}-\d{2}-\d{4}\b", "SSN/SIN"),
-        (r"\b\d{9}\b", "SIN"),
-        (r"\b(?:\d[ -]*?){13,19}\b", "credit card"),
-        (r"\b[A-Z]{1,2}\d{6,8}\b", "passport"),
-        (r"\b[A-Z0-9]{8,9}\b", "passport"),
-    ]
-
-    for pattern, label in patterns:
-        if re.search(pattern, masked):
-            masked = re.sub(pattern, "[REDACTED]", masked)
+    for pattern, label in _SENSITIVE_PATTERNS:
+        masked, count = pattern.subn("[REDACTED]", masked)
+        if count:
             warnings.append(f"Sensitive data detected: {label}. Please avoid sharing it.")
 
     return masked, warnings
 
 
 def _build_messages(payload: ChatRequest, sanitized: str, warnings: List[str]) -> List[dict]:
-    developer = (
-        "You are an assistant that helps users fill Canadian PR forms. "
-        "Focus ONLY on the selected field. Do NOT provide legal advice. "
-        "Warn if sensitive data is present. Respond in the user's language. "
-        "Return a JSON object with keys: assistant_answer, suggested_fill_en, warnings."
-    )
     user = {
         "selected_field_id": payload.selected_field_id,
         "selected_field_label_en": payload.selected_field_label,
@@ -127,27 +277,27 @@ def _build_messages(payload: ChatRequest, sanitized: str, warnings: List[str]) -
         "sensitive_data_warnings": warnings,
     }
     return [
-        {"role": "developer", "content": developer},
-        {"role": "user", "content": json.dumps(user, ensure_ascii=False)},
+        {"role": "developer", "content": _DEVELOPER_PROMPT},
+        {"role": "user", "content": orjson.dumps(user).decode()},
     ]
 
 
 def _call_llm(messages: List[dict]) -> str:
-    return json.dumps(
+    return orjson.dumps(
         {
             "assistant_answer": "AI is currently disabled. Please connect an LLM provider.",
             "suggested_fill_en": "",
             "warnings": [],
         }
-    )
+    ).decode()
 
 
 def _parse_model_json(text: str) -> Dict[str, object]:
     try:
-        data = json.loads(text)
+        data = orjson.loads(text)
         if isinstance(data, dict):
             return data
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         pass
     return {
         "assistant_answer": text.strip(),
@@ -156,10 +306,31 @@ def _parse_model_json(text: str) -> Dict[str, object]:
     }
 
 
-def _load_pdf_reader() -> PdfReader:
-    if not os.path.exists(OFFICIAL_PDF_PATH):
+def _clean_model_text(value: object) -> str:
+    if not isinstance(value, str):
+        value = str(value)
+    return value.strip()
+
+
+def _load_pdf_bytes() -> bytes:
+    try:
+        mtime = os.path.getmtime(OFFICIAL_PDF_PATH)
+    except OSError:
         raise HTTPException(status_code=404, detail="Official PDF not found.")
-    reader = PdfReader(OFFICIAL_PDF_PATH)
+    with _pdf_lock:
+        cached = _pdf_cache.get(OFFICIAL_PDF_PATH)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(OFFICIAL_PDF_PATH, "rb") as f:
+            data = f.read()
+        _pdf_cache[OFFICIAL_PDF_PATH] = (mtime, data)
+    return data
+
+
+def _load_pdf_reader(data: Optional[bytes] = None) -> PdfReader:
+    # Each caller gets its own reader: PdfReader resolves objects lazily from a
+    # shared stream, so one instance must not be used across worker threads.
+    reader = PdfReader(BytesIO(data if data is not None else _load_pdf_bytes()))
     if reader.is_encrypted:
         try:
             reader.decrypt("")
@@ -181,8 +352,21 @@ def _list_pdf_fields(reader: PdfReader) -> Dict[str, Optional[str]]:
     return result
 
 
+def _load_pdf_fields_json() -> bytes:
+    data = _load_pdf_bytes()
+    cached = _pdf_fields_cache.get(OFFICIAL_PDF_PATH)
+    # The bytes cache hands out a new object whenever the PDF changes on disk.
+    if cached and cached[0] is data:
+        return cached[1]
+    content = orjson.dumps(_list_pdf_fields(_load_pdf_reader(data)))
+    _pdf_fields_cache[OFFICIAL_PDF_PATH] = (data, content)
+    return content
+
+
 def _fill_pdf(fields: Dict[str, str], flatten: bool) -> bytes:
     reader = _load_pdf_reader()
+    # Incremental mode (PdfWriter(..., incremental=True)) is slower on this template and
+    # its damaged xref table leaves the appended field values unreadable, so clone instead.
     writer = PdfWriter(clone_from=reader)
     normalized = {}
     for key, value in fields.items():
@@ -222,8 +406,15 @@ def _stamp_pdf(fields: Dict[str, str], pages: List[Dict[str, float]], stamps: Li
             flatten=flatten,
         )
 
+    stamps_by_page: Dict[int, List[Tuple[PdfStampItem, str]]] = defaultdict(list)
+    for item in stamps:
+        text = (item.text or "").strip()
+        if text:
+            stamps_by_page[item.page].append((item, text))
+
     overlay_buf = BytesIO()
-    c = canvas.Canvas(overlay_buf)
+    # The overlay is only parsed back by pypdf for merging, so compressing it is wasted work.
+    c = canvas.Canvas(overlay_buf, pageCompression=0)
 
     page_count = len(writer.pages)
     for page_index in range(page_count):
@@ -233,21 +424,29 @@ def _stamp_pdf(fields: Dict[str, str], pages: List[Dict[str, float]], stamps: Li
         page_h_pt = float(media_box.height)
         c.setPageSize((page_w_pt, page_h_pt))
 
+        page_stamps = stamps_by_page.get(page_index)
+        if not page_stamps:
+            # Still emit a blank page so overlay pages line up with the form.
+            c.showPage()
+            continue
+
         page_meta = pages[page_index] if page_index < len(pages) else {"width": 1.0, "height": 1.0}
         page_w_px = float(page_meta.get("width", 1.0)) or 1.0
         page_h_px = float(page_meta.get("height", 1.0)) or 1.0
-
-        for item in stamps:
-            if item.page != page_index:
-                continue
-            text = (item.text or "").strip()
-            if not text:
-                continue
-            x_pt = (item.x_px / page_w_px) * page_w_pt
+        x_scale = page_w_pt / page_w_px
+        y_scale = page_h_pt / page_h_px
+        font_scale = y_scale * 0.8
+        # showPage() resets the canvas font, so the first stamp on each page sets it again.
+        last_font_size = None
+
+        for item, text in page_stamps:
+            x_pt = item.x_px * x_scale
             baseline_px = item.y_px + (item.height_px * 0.75)
-            y_pt = page_h_pt - (baseline_px / page_h_px) * page_h_pt
-            font_size = max(7.0, min(12.0, (item.height_px / page_h_px) * page_h_pt * 0.8))
-            c.setFont("Helvetica", font_size)
+            y_pt = page_h_pt - baseline_px * y_scale
+            font_size = round(max(7.0, min(12.0, item.height_px * font_scale)), 1)
+            if font_size != last_font_size:
+                c.setFont("Helvetica", font_size)
+                last_font_size = font_size
             c.drawString(x_pt, y_pt, text)
 
         c.showPage()
@@ -257,7 +456,7 @@ def _stamp_pdf(fields: Dict[str, str], pages: List[Dict[str, float]], stamps: Li
     overlay_reader = PdfReader(overlay_buf)
 
     for i, page in enumerate(writer.pages):
-        if i < len(overlay_reader.pages):
+        if i in stamps_by_page and i < len(overlay_reader.pages):
             page.merge_page(overlay_reader.pages[i])
 
     out = BytesIO()
@@ -265,6 +464,35 @@ def _stamp_pdf(fields: Dict[str, str], pages: List[Dict[str, float]], stamps: Li
     return out.getvalue()
 
 
+def _run_pdf_job(func, *args):
+    # HTTPException cannot be unpickled in the parent, so send back its fields instead.
+    try:
+        return func(*args), None
+    except HTTPException as exc:
+        return None, (exc.status_code, exc.detail)
+
+
+async def _render_pdf(func, *args) -> bytes:
+    # pypdf and reportlab are pure Python, so run them in worker processes to avoid the GIL.
+    loop = asyncio.get_running_loop()
+    pool = _get_pdf_pool()
+    try:
+        pdf_bytes, error = await loop.run_in_executor(pool, _run_pdf_job, func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM); drop the pool so the next request starts a fresh one.
+        _discard_pdf_pool(pool)
+        raise HTTPException(status_code=503, detail="PDF renderer restarted, please try again.")
+    if error is not None:
+        raise HTTPException(status_code=error[0], detail=error[1])
+    return pdf_bytes
+
+
+def _pdf_response(pdf_bytes: bytes) -> Response:
+    # The bytes unpickled from the worker are sent as-is; Response does not copy them again.
+    headers = {"Content-Disposition": "attachment; filename=pr-card-filled.pdf"}
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+
+
 @app.get("/", response_class=HTMLResponse)
 def home(request: Request):
     return templates.TemplateResponse(
@@ -291,29 +519,26 @@ def pr_card_form_pdf(request: Request):
 
 @app.get("/api/pr-card-pdf/fields")
 def pr_card_pdf_fields():
-    reader = _load_pdf_reader()
-    return _list_pdf_fields(reader)
+    return Response(content=_load_pdf_fields_json(), media_type="application/json")
 
 
 @app.post("/api/pr-card-pdf")
-def pr_card_pdf_fill(payload: PdfFillRequest):
-    pdf_bytes = _fill_pdf(payload.fields, payload.flatten)
-    headers = {"Content-Disposition": "attachment; filename=pr-card-filled.pdf"}
-    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+async def pr_card_pdf_fill(payload: PdfFillRequest):
+    pdf_bytes = await _render_pdf(_fill_pdf, payload.fields, payload.flatten)
+    return _pdf_response(pdf_bytes)
 
 
 @app.post("/api/pr-card-pdf-stamp")
-def pr_card_pdf_stamp(payload: PdfStampRequest):
-    pdf_bytes = _stamp_pdf(payload.fields, payload.pages, payload.stamps, payload.flatten)
-    headers = {"Content-Disposition": "attachment; filename=pr-card-filled.pdf"}
-    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+async def pr_card_pdf_stamp(payload: PdfStampRequest):
+    pdf_bytes = await _render_pdf(_stamp_pdf, payload.fields, payload.pages, payload.stamps, payload.flatten)
+    return _pdf_response(pdf_bytes)
 
 
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(request: Request, payload: ChatRequest):
     ip = _get_client_ip(request)
-    if _rate_limited(ip):
-        return JSONResponse(
+    if await _rate_limited(ip):
+        return ORJSONResponse(
             status_code=429,
             content={
                 "assistant_answer": "Please wait a moment before sending more messages.",
@@ -327,10 +552,12 @@ async def chat(request: Request, payload: ChatRequest):
     messages = _build_messages(payload, sanitized, warnings)
     raw = _call_llm(messages)
     parsed = _parse_model_json(raw)
-    merged_warnings = warnings + list(parsed.get("warnings", []))
+    extra_warnings = parsed.get("warnings")
+    if extra_warnings:
+        warnings.extend(extra_warnings)
 
     return ChatResponse(
-        assistant_answer=str(parsed.get("assistant_answer", "")).strip(),
-        suggested_fill_en=str(parsed.get("suggested_fill_en", "")).strip(),
-        warnings=merged_warnings,
+        assistant_answer=_clean_model_text(parsed.get("assistant_answer", "")),
+        suggested_fill_en=_clean_model_text(parsed.get("suggested_fill_en", "")),
+        warnings=warnings,
     )